@@ -7,11 +7,27 @@
 # FA-PI-W: feedback alignment initialized B from random W
 # FA-PI-B: feedback alignment initialized W from random B
 import argparse
+import ctypes
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
+import shutil
+import struct
+import tempfile
+import threading
+import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import sklearn.datasets
 import sklearn.cross_validation
+try:
+    import scipy.linalg
+    import scipy.sparse
+except ImportError:
+    scipy = None
 
 ## activations.
 # note: dXXX functions are defined to hold df(z = f(y)) = d(f(y))/dy but not df(y) = d(f(y))/dy
@@ -20,7 +36,7 @@ def dsigmoid(z): return z * (1.0 - z)
 def tanh(y): return np.tanh(y)
 def dtanh(z): return 1.0 - z**2.0
 def relu(y): return np.maximum(0, y)
-def drelu(z): return (z > 0) * 1.0
+def drelu(z): return (z > 0).astype(z.dtype)
 def identity(y): return y
 def didentity(z): return 1.0
 activation_funcs = {
@@ -29,12 +45,45 @@ activation_funcs = {
         'relu': (relu, drelu),
         'identity': (identity, didentity),
         }
+# in-place variants for the fused layer kernel and the in-place backward.
+# fXXX_inplace overwrites and returns z, or writes f(z) into `out` (which may be a strided view) and returns it.
+# mul_dXXX(delta, z, scratch) does delta *= dXXX(z) using scratch.
+def sigmoid_inplace(z, out = None):
+    out = np.negative(z, out=z if out is None else out)
+    np.exp(out, out=out)
+    out += 1.0
+    return np.reciprocal(out, out=out)
+def tanh_inplace(z, out = None): return np.tanh(z, out=z if out is None else out)
+def relu_inplace(z, out = None): return np.maximum(z, 0, out=z if out is None else out)
+def identity_inplace(z, out = None):
+    if out is None:
+        return z
+    out[...] = z
+    return out
+def mul_dsigmoid(delta, z, scratch):
+    np.subtract(1.0, z, out=scratch)
+    scratch *= z
+    delta *= scratch
+def mul_dtanh(delta, z, scratch):
+    np.multiply(z, z, out=scratch)
+    np.subtract(1.0, scratch, out=scratch)
+    delta *= scratch
+def mul_drelu(delta, z, scratch):
+    np.greater(z, 0, out=scratch)
+    delta *= scratch
+def mul_didentity(delta, z, scratch): pass
+inplace_activation_funcs = {
+        'sigmoid': (sigmoid_inplace, mul_dsigmoid),
+        'tanh': (tanh_inplace, mul_dtanh),
+        'relu': (relu_inplace, mul_drelu),
+        'identity': (identity_inplace, mul_didentity),
+        }
 
 ## loss functions
 def mse_loss(y_pred, y_true): return 0.5 * (y_pred -  y_true)**2
 def mse_loss_prime(y_pred, y_true): return y_pred -  y_true
 def softmax(y):
-    ey = np.exp(y)
+    ey = np.exp(y - y.max(axis=1)[:, np.newaxis])
     return ey / ey.sum(axis=1)[:, np.newaxis]
 def softmax_cross_entropy_loss(y_pred, y_true):
     p_pred = softmax(y_pred)
@@ -42,35 +91,753 @@ def softmax_cross_entropy_loss(y_pred, y_true):
     return (- p_true * np.log(p_pred) - (1.0 - p_true) * np.log(1.0 - p_pred)).sum(axis=1)
 def softmax_cross_entropy_loss_prime(y_pred, y_true):
     return softmax(y_pred) - y_true
-loss_funcs = {
-        'mse': (mse_loss, mse_loss_prime),
-        'softmax_cross_entropy': (softmax_cross_entropy_loss, softmax_cross_entropy_loss_prime),
+
+# loss objects used by MLP: loss(y_pred, y_true) returns (per-sample loss, gradient w.r.t. y_pred).
+class ElementwiseLoss(object):
+    def __init__(self, f, fprime):
+        self.f, self.fprime = f, fprime
+
+    def __call__(self, y_pred, y_true, gradient = True):
+        loss = self.f(y_pred, y_true)
+        if len(loss.shape) == 2:
+            loss = loss.sum(axis=1)
+        return loss, self.fprime(y_pred, y_true) if gradient else None
+
+class SoftmaxCrossEntropy(object):
+    # fused softmax_cross_entropy_loss and its gradient for one-hot or int index targets.
+    # the max-shifted softmax is computed once per call and shared by the loss and the gradient.
+    def __call__(self, y_pred, y_true, gradient = True):
+        shifted = y_pred - y_pred.max(axis=1)[:, np.newaxis]
+        probs = np.exp(shifted)
+        norm = probs.sum(axis=1)[:, np.newaxis]
+        probs /= norm
+        log_probs = shifted
+        log_probs -= np.log(norm)
+        # log(1 - p), clipped so that saturated classes stay finite.
+        log_rest = np.log1p(-np.minimum(probs, 1.0 - np.finfo(probs.dtype).eps))
+        if len(y_true.shape) == 1:
+            rows = np.arange(len(y_true))
+            loss = - log_probs[rows, y_true] - log_rest.sum(axis=1) + log_rest[rows, y_true]
+            if gradient:
+                delta = probs.copy()
+                delta[rows, y_true] -= 1.0
+        else:
+            loss = (- y_true * log_probs - (1.0 - y_true) * log_rest).sum(axis=1)
+            if gradient:
+                delta = probs - y_true
+        return loss, delta if gradient else None
+
+losses = {
+        'mse': lambda: ElementwiseLoss(mse_loss, mse_loss_prime),
+        'softmax_cross_entropy': SoftmaxCrossEntropy,
+        'sparse_softmax_cross_entropy': SoftmaxCrossEntropy,
         }
 
+def class_labels(ys):
+    # class indices of one-hot rows; index targets are returned as is.
+    return ys if len(ys.shape) == 1 else ys.argmax(axis=1)
+
 ## utility
 def normalize_xavier(x, n):
     return x / (np.var(x) * n)
 
 def add_bias(x):
     assert len(x.shape) == 2
-    return np.hstack([x, np.ones((x.shape[0], 1))])
+    return np.hstack([x, np.ones((x.shape[0], 1), x.dtype)])
+
+def randomized_svd(w, rank, n_oversamples = 10, n_iter = 2, seed = 0):
+    # "Finding structure with randomness", N.Halko+, SIAM Review 2011.
+    rng = np.random.RandomState(seed)
+    k = min(rank + n_oversamples, min(w.shape))
+    q = np.dot(w, rng.randn(w.shape[1], k).astype(w.dtype))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(q)
+        q = np.dot(w, np.dot(w.T, q))
+    q, _ = np.linalg.qr(q)
+    u, s, vt = np.linalg.svd(np.dot(q.T, w), full_matrices=False)
+    return np.dot(q, u[:, :rank]), s[:rank], vt[:rank]
+
+# methods: 'inv' explicit inverse, 'cholesky' cho_solve, 'svd' (truncated to `rank` if given), 'randomized' svd.
+pinv_methods = ['inv', 'cholesky', 'svd', 'randomized']
+
+def fused_layer(x, w, f_inplace, out = None):
+    # f(x W[:, :-1]^T + W[:, -1]) on views of w, without building the bias-augmented input.
+    z = np.dot(x, w[:, :-1].T, out=out)
+    z += w[:, -1]
+    return f_inplace(z)
 
-def pseudo_inverse(w):
+def pseudo_inverse(w, method = 'inv', dtype = None, rank = None):
     eps = 1.0e-3 # avoid singular matrix
-    if w.shape[0] <= w.shape[1]:
-        b = np.dot(w.T, np.linalg.inv(np.dot(w, w.T) + np.eye(w.shape[0]) * eps))
+    if dtype is not None:
+        w = w.astype(dtype, copy=False)
+    if method == 'inv':
+        if w.shape[0] <= w.shape[1]:
+            b = np.dot(w.T, np.linalg.inv(np.dot(w, w.T) + np.eye(w.shape[0], dtype=w.dtype) * eps))
+        else:
+            b = np.dot(np.linalg.inv(np.dot(w.T, w) + np.eye(w.shape[1], dtype=w.dtype) * eps), w.T)
+    elif method == 'cholesky':
+        if scipy is None:
+            raise RuntimeError('cholesky pseudo inverse requires scipy')
+        # the regularized gram matrix is symmetric positive definite.
+        if w.shape[0] <= w.shape[1]:
+            c = scipy.linalg.cho_factor(np.dot(w, w.T) + np.eye(w.shape[0], dtype=w.dtype) * eps)
+            b = scipy.linalg.cho_solve(c, w).T
+        else:
+            c = scipy.linalg.cho_factor(np.dot(w.T, w) + np.eye(w.shape[1], dtype=w.dtype) * eps)
+            b = scipy.linalg.cho_solve(c, w.T)
+    elif method == 'svd' or method == 'randomized':
+        # w = u s v^T  =>  w^T (w w^T + eps I)^-1 = v s/(s^2 + eps) u^T
+        if method == 'svd':
+            u, s, vt = np.linalg.svd(w, full_matrices=False)
+            if rank is not None:
+                u, s, vt = u[:, :rank], s[:rank], vt[:rank]
+        else:
+            u, s, vt = randomized_svd(w, rank if rank is not None else min(w.shape))
+        b = np.dot(vt.T * (s / (s**2 + eps)), u.T)
     else:
-        b = np.dot(np.linalg.inv(np.dot(w.T, w) + np.eye(w.shape[1]) * eps), w.T)
+        raise RuntimeError('unknown pseudo inverse method')
     #eye = np.dot(w, b)
     #print np.diag(eye)
     return b
 
-class MLP(object):
-    def __init__(self, input_dim, layers, loss_type, learning = 'BP', verbose = False):
+def benchmark_pseudo_inverse(shapes, n_repeat = 20):
+    # speed and accuracy of each backend against the float64 full svd solution.
+    rows = []
+    for shape in shapes:
+        w = normalize_xavier(np.random.randn(*shape), np.sqrt(sum(shape)))
+        reference = pseudo_inverse(w, 'svd', np.float64)
+        configs = [(method, None) for method in pinv_methods] + [
+                ('svd', min(shape) // 2), ('randomized', min(shape) // 2)]
+        for method, rank in configs:
+            if method == 'cholesky' and scipy is None:
+                continue
+            for dtype in [np.float32, np.float64]:
+                t0 = time.time()
+                for _ in range(n_repeat):
+                    b = pseudo_inverse(w, method, dtype, rank)
+                elapsed = (time.time() - t0) / n_repeat
+                error = np.linalg.norm(b - reference) / np.linalg.norm(reference)
+                rows.append(dict(shape='%dx%d' % shape, method=method, rank=rank or min(shape),
+                    dtype=np.dtype(dtype).name, msec=elapsed * 1000.0, error=error))
+    return pd.DataFrame(rows, columns=['shape', 'method', 'rank', 'dtype', 'msec', 'error'])
+
+class TransportCache(object):
+    # keeps the pseudo inverse of each layer and recomputes it only every `refresh_every` steps,
+    # or when the relative change of the weight since the last refresh exceeds `tolerance`.
+    # refresh_every = 1 recomputes on every step, i.e. the exact PI update. it defaults to 1 without a tolerance
+    # and to no age limit with one; pass both to refresh on whichever comes first.
+    def __init__(self, refresh_every = None, tolerance = None, method = 'inv', dtype = None, rank = None):
+        if refresh_every is None:
+            refresh_every = 1 if tolerance is None else 0
+        self.refresh_every = refresh_every
+        self.tolerance = tolerance
+        self.method = method
+        self.dtype = dtype
+        self.rank = rank
+        self.transports = {}
+        self.references = {}
+        self.ages = {}
+
+    def needs_refresh(self, i, w):
+        if i not in self.transports:
+            return True
+        if self.refresh_every and self.ages[i] >= self.refresh_every:
+            return True
+        if self.tolerance is not None:
+            ref = self.references[i]
+            return np.linalg.norm(w - ref) > self.tolerance * np.linalg.norm(ref)
+        return False
+
+    def get(self, i, w):
+        if self.needs_refresh(i, w):
+            self.transports[i] = pseudo_inverse(w, self.method, self.dtype, self.rank).T.astype(w.dtype)
+            if self.tolerance is not None:
+                self.references[i] = w.copy()
+            self.ages[i] = 0
+        self.ages[i] += 1
+        return self.transports[i]
+
+    def clear(self):
+        self.transports, self.references, self.ages = {}, {}, {}
+
+    def get_state(self, prefix = 'transport_cache.'):
+        state = {}
+        for name in ['transports', 'references', 'ages']:
+            for i, a in getattr(self, name).items():
+                state['%s%s.%d' % (prefix, name, i)] = np.array(a)
+        return state
+
+    def set_state(self, state, prefix = 'transport_cache.'):
+        self.clear()
+        for key, a in state.items():
+            if key.startswith(prefix):
+                name, i = key[len(prefix):].split('.')
+                getattr(self, name)[int(i)] = a if a.shape else int(a)
+
+optimizer_types = ['sgd', 'momentum', 'nesterov', 'rmsprop', 'adam']
+
+class Optimizer(object):
+    # update rules for (..., ch_out, ch_in + 1) weights with the bias in the last column.
+    # per-layer state buffers are shaped like the weights, allocated on the first step and updated in place;
+    # the gradients are consumed as scratch. momentum is beta1 for adam, decay is rho for rmsprop (default 0.9)
+    # and beta2 for adam (default 0.999).
+    def __init__(self, kind = 'sgd', momentum = 0.9, decay = None, eps = 1e-8):
+        if kind not in optimizer_types:
+            raise RuntimeError('unknown optimizer')
+        self.kind = kind
+        self.momentum = momentum
+        self.decay = decay if decay is not None else 0.999 if kind == 'adam' else 0.9
+        self.eps = eps
+        self.buffers = {}
+        self.steps = {}
+
+    def buffer(self, name, i, w):
+        key = (name, i)
+        if key not in self.buffers:
+            self.buffers[key] = np.zeros(w.shape, w.dtype)
+        return self.buffers[key]
+
+    def step(self, i, w, grad_w, grad_b, eta):
+        self.steps[i] = self.steps.get(i, 0) + 1
+        if self.kind == 'adam':
+            t = self.steps[i]
+            eta = eta * np.sqrt(1.0 - self.decay ** t) / (1.0 - self.momentum ** t)
+        names = {'sgd': [], 'momentum': ['velocity'], 'nesterov': ['velocity'],
+                'rmsprop': ['square', 'scratch'], 'adam': ['mean', 'square', 'scratch']}[self.kind]
+        buffers = [self.buffer(name, i, w) for name in names]
+        self.apply(w[..., :-1], grad_w, [b[..., :-1] for b in buffers], eta)
+        self.apply(w[..., -1], grad_b, [b[..., -1] for b in buffers], eta)
+
+    def apply(self, w, g, buffers, eta):
+        mu, rho = self.momentum, self.decay
+        if self.kind == 'sgd':
+            g *= eta
+            w -= g
+        elif self.kind == 'momentum':
+            v, = buffers
+            v *= mu
+            v += g
+            g[...] = v
+            g *= eta
+            w -= g
+        elif self.kind == 'nesterov':
+            # w -= eta * (g + mu * v) with the updated velocity.
+            v, = buffers
+            v *= mu
+            v += g
+            g *= eta
+            w -= g
+            g[...] = v
+            g *= eta * mu
+            w -= g
+        elif self.kind == 'rmsprop':
+            s, tmp = buffers
+            np.multiply(g, g, out=tmp)
+            tmp *= 1.0 - rho
+            s *= rho
+            s += tmp
+            np.sqrt(s, out=tmp)
+            tmp += self.eps
+            g /= tmp
+            g *= eta
+            w -= g
+        elif self.kind == 'adam':
+            # eta already includes the bias correction.
+            m, s, tmp = buffers
+            np.multiply(g, 1.0 - mu, out=tmp)
+            m *= mu
+            m += tmp
+            np.multiply(g, g, out=tmp)
+            tmp *= 1.0 - rho
+            s *= rho
+            s += tmp
+            np.sqrt(s, out=tmp)
+            tmp += self.eps
+            np.divide(m, tmp, out=g)
+            g *= eta
+            w -= g
+
+    def get_state(self, prefix = 'optimizer.'):
+        state = {}
+        for (name, i), a in self.buffers.items():
+            if name != 'scratch':
+                state['%s%s.%d' % (prefix, name, i)] = a.copy()
+        for i, t in self.steps.items():
+            state['%ssteps.%d' % (prefix, i)] = np.array(t)
+        return state
+
+    def set_state(self, state, prefix = 'optimizer.'):
+        self.buffers, self.steps = {}, {}
+        for key, a in state.items():
+            if key.startswith(prefix):
+                name, i = key[len(prefix):].split('.')
+                if name == 'steps':
+                    self.steps[int(i)] = int(a)
+                else:
+                    self.buffers[(name, int(i))] = a.copy()
+
+def validation_subset(xs, ys, size = None, seed = 0):
+    # a fixed random subset of `size` samples in dataset order, drawn once per fit. None keeps everything.
+    if size is None or size >= xs.shape[0]:
+        return xs, ys
+    idx = np.sort(np.random.RandomState(seed).choice(xs.shape[0], size, replace=False))
+    return xs[idx], ys[idx]
+
+schedule_types = ['constant', 'step', 'cosine', 'plateau']
+
+class LearningRateSchedule(object):
+    # per-epoch factor on fit's learning_rate. 'step' multiplies by gamma every step_size epochs, 'cosine' anneals
+    # to min_factor over n_epoch, 'plateau' multiplies by gamma once the monitored loss has not improved for
+    # patience epochs. warmup ramps any of them up linearly over the first warmup epochs.
+    def __init__(self, kind = 'constant', warmup = 0, step_size = 10, gamma = 0.1, min_factor = 0.0,
+            patience = 5, threshold = 1e-4):
+        if kind not in schedule_types:
+            raise RuntimeError('unknown schedule')
+        self.kind = kind
+        self.warmup = warmup
+        self.step_size = step_size
+        self.gamma = gamma
+        self.min_factor = min_factor
+        self.patience = patience
+        self.threshold = threshold
+        self.scale, self.best, self.bad_epochs = 1.0, np.inf, 0
+
+    def factor(self, iepoch, n_epoch):
+        if self.kind == 'step':
+            f = self.gamma ** (iepoch // self.step_size)
+        elif self.kind == 'cosine':
+            f = self.min_factor + (1.0 - self.min_factor) * 0.5 * (1.0 + np.cos(np.pi * iepoch / float(n_epoch)))
+        else:
+            f = self.scale
+        if iepoch < self.warmup:
+            f *= (iepoch + 1) / float(self.warmup)
+        return f
+
+    def update(self, loss):
+        # called after every epoch with the monitored loss.
+        if loss < self.best - self.threshold:
+            self.best, self.bad_epochs = loss, 0
+            return
+        self.bad_epochs += 1
+        if self.kind == 'plateau' and self.bad_epochs >= self.patience:
+            self.scale *= self.gamma
+            self.bad_epochs = 0
+
+    def get_state(self, prefix = 'schedule.'):
+        return dict((prefix + name, np.array(getattr(self, name))) for name in ['scale', 'best', 'bad_epochs'])
+
+    def set_state(self, state, prefix = 'schedule.'):
+        self.scale, self.best, self.bad_epochs = [state[prefix + name][()] for name in ['scale', 'best', 'bad_epochs']]
+
+class EarlyStopping(object):
+    # stops fit once the monitored loss has not improved by min_delta for patience epochs.
+    # restore_best: copy the weights at the best epoch and put them back when stopping or at the end.
+    def __init__(self, patience = 10, min_delta = 0.0, restore_best = False):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best = restore_best
+        self.best, self.bad_epochs = np.inf, 0
+        self.best_weights = None
+
+    def update(self, loss, model):
+        # True when fit should stop.
+        if loss < self.best - self.min_delta:
+            self.best, self.bad_epochs = loss, 0
+            if self.restore_best:
+                if self.best_weights is None:
+                    self.best_weights = [w.copy() for w in model.weights]
+                for b, w in zip(self.best_weights, model.weights):
+                    b[...] = w
+            return False
+        self.bad_epochs += 1
+        return self.bad_epochs >= self.patience
+
+    def restore(self, model):
+        if self.best_weights is None:
+            return
+        for b, w in zip(self.best_weights, model.weights):
+            w[...] = b
+        for b, w in zip(self.best_weights, getattr(model, 'master_weights', None) or []):
+            w[...] = b
+
+    def get_state(self, prefix = 'early_stopping.'):
+        state = dict((prefix + name, np.array(getattr(self, name))) for name in ['best', 'bad_epochs'])
+        for i, b in enumerate(self.best_weights or []):
+            state['%sbest_weights.%d' % (prefix, i)] = b.copy()
+        return state
+
+    def set_state(self, state, prefix = 'early_stopping.'):
+        self.best, self.bad_epochs = [state[prefix + name][()] for name in ['best', 'bad_epochs']]
+        n = len([key for key in state if key.startswith(prefix + 'best_weights.')])
+        self.best_weights = [state['%sbest_weights.%d' % (prefix, i)].copy() for i in range(n)] or None
+
+sampler_modes = ['sequential', 'shuffled', 'stratified']
+
+class MinibatchSampler(object):
+    # epoch orders for fit. 'stratified' spreads every class evenly over the epoch so each minibatch
+    # keeps the class ratio. it owns a RandomState, independent of the global np.random seed.
+    def __init__(self, mode = 'shuffled', seed = None):
+        if mode not in sampler_modes:
+            raise RuntimeError('unknown sampler mode')
+        self.mode = mode
+        self.rng = np.random.RandomState(seed)
+
+    def order(self, ys):
+        # sample order for one epoch, or None to keep the dataset order.
+        n = ys.shape[0]
+        if self.mode == 'sequential':
+            return None
+        if self.mode == 'shuffled':
+            return self.rng.permutation(n)
+        labels = class_labels(ys)
+        position = np.empty(n)
+        for c in np.unique(labels):
+            idx = self.rng.permutation(np.flatnonzero(labels == c))
+            position[idx] = (np.arange(len(idx)) + self.rng.uniform(size=len(idx))) / len(idx)
+        return np.argsort(position, kind='mergesort')
+
+    def blocks(self, n, batchsize):
+        # minibatches as slices of the (reordered) epoch arrays.
+        return [slice(i, min(n, i + batchsize)) for i in range(0, n, batchsize)]
+
+fit_log_types = ['train-intermediate', 'train', 'validation']
+
+class FitLog(object):
+    # columnar fit log. rows (n, loss, acc, type, model) live in a growable numpy structured array;
+    # with spill_dir, every chunk_size rows are written out as a .npy file and dropped from memory. the chunks go
+    # to a private directory under spill_dir that close() removes; fit closes the log it replaces.
+    # n_models: EnsembleMLP logs, where every append writes one row per member.
+    row_dtype = np.dtype([('n', np.int64), ('loss', np.float64), ('acc', np.float64), ('type', np.int8), ('model', np.int32)])
+
+    def __init__(self, n_models = None, spill_dir = None, chunk_size = 1 << 16):
+        self.n_models = n_models
+        self.width = 1 if n_models is None else n_models
+        self.spill_dir = spill_dir
+        self.chunk_dir = None
+        self.rows = np.empty(max(chunk_size, self.width) if spill_dir else 1024, self.row_dtype)
+        self.size = 0
+        self.chunks = []
+
+    def append(self, n, loss, acc, type):
+        if self.size + self.width > len(self.rows):
+            if self.spill_dir:
+                self.spill()
+            else:
+                self.rows = np.resize(self.rows, 2 * len(self.rows) + self.width)
+        rows = self.rows[self.size:self.size + self.width]
+        rows['n'] = n
+        rows['loss'] = loss
+        rows['acc'] = acc
+        rows['type'] = fit_log_types.index(type)
+        rows['model'] = np.arange(self.width)
+        self.size += self.width
+
+    def spill(self, rows = None):
+        if self.chunk_dir is None:
+            self.chunk_dir = tempfile.mkdtemp(prefix='fit_log_', dir=self.spill_dir)
+        fd, path = tempfile.mkstemp(suffix='.npy', dir=self.chunk_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, self.rows[:self.size] if rows is None else rows)
+        self.chunks.append(path)
+        if rows is None:
+            self.size = 0
+
+    def restore(self, rows):
+        # replaces the content with rows saved from array().
+        self.remove_chunks()
+        self.size = 0
+        if self.spill_dir:
+            self.spill(rows)
+            return
+        if len(rows) > len(self.rows):
+            self.rows = np.empty(2 * len(rows), self.row_dtype)
+        self.rows[:len(rows)] = rows
+        self.size = len(rows)
+
+    def remove_chunks(self):
+        for path in self.chunks:
+            os.remove(path)
+        self.chunks = []
+
+    def close(self):
+        # deletes the spilled chunks. the rows still in memory stay readable.
+        self.remove_chunks()
+        if self.chunk_dir is not None:
+            shutil.rmtree(self.chunk_dir, ignore_errors=True)
+            self.chunk_dir = None
+
+    def __del__(self):
+        self.close()
+
+    def snapshot(self):
+        # a function that returns the current array() later, e.g. on a checkpoint writer thread. spilled chunks
+        # are never modified, so only the rows still in memory are copied now.
+        chunks, rows = list(self.chunks), self.rows[:self.size].copy()
+        return lambda: np.concatenate([np.load(path, mmap_mode='r') for path in chunks] + [rows])
+
+    def array(self):
+        parts = [np.load(path, mmap_mode='r') for path in self.chunks] + [self.rows[:self.size]]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def select(self, type):
+        rows = self.array()
+        return rows[rows['type'] == fit_log_types.index(type)]
+
+    def __len__(self):
+        return len(self.array())
+
+    def to_frame(self):
+        rows = self.array()
+        columns = dict(n=rows['n'], loss=rows['loss'], acc=rows['acc'],
+                type=np.array(fit_log_types, dtype=object)[rows['type']])
+        if self.n_models is not None:
+            columns['model'] = rows['model']
+        return pd.DataFrame(columns, columns=sorted(columns))
+
+class BatchMetrics(object):
+    # running loss/accuracy sums of the current epoch. every `stride` minibatches the running means
+    # are appended to `log` as a 'train-intermediate' row.
+    def __init__(self, log, stride = 1):
+        self.log = log
+        self.stride = max(1, stride)
+        self.step = 0
+        self.mean_loss = np.empty(log.width)
+        self.mean_acc = np.empty(log.width)
+        self.start_epoch(0)
+
+    def start_epoch(self, total_samples):
+        self.offset = total_samples
+        self.loss_sum = np.zeros(self.log.width)
+        self.correct = np.zeros(self.log.width)
+        self.count = 0
+
+    def add(self, loss_sum, n_correct, n_batch):
+        self.loss_sum += loss_sum
+        self.correct += n_correct
+        self.count += n_batch
+        self.step += 1
+        if self.step % self.stride == 0:
+            np.divide(self.loss_sum, self.count, out=self.mean_loss)
+            np.divide(self.correct, self.count, out=self.mean_acc)
+            self.log.append(self.offset + self.count, self.mean_loss, self.mean_acc, 'train-intermediate')
+
+    def means(self):
+        loss, acc = self.loss_sum / self.count, self.correct / self.count
+        return (loss[0], acc[0]) if self.log.n_models is None else (loss, acc)
+
+def rng_get_state(rng = None):
+    # RandomState state as (key array, json-able remainder). rng None is the global np.random state.
+    name, keys, pos, has_gauss, cached_gaussian = (np.random if rng is None else rng).get_state()
+    return keys, [name, int(pos), int(has_gauss), float(cached_gaussian)]
+
+def rng_set_state(rng, keys, rest):
+    name, pos, has_gauss, cached_gaussian = rest
+    (np.random if rng is None else rng).set_state((str(name), keys, pos, has_gauss, cached_gaussian))
+
+class Checkpointer(object):
+    # periodic fit checkpoints. every `every` minibatches fit hands over a copied snapshot, and a background
+    # thread writes it to `path` through a temporary file and a rename, so training only pays for the copy.
+    # snapshot values may also be functions, called on the writer thread to build the array.
+    # at most one snapshot waits for the writer; a slow disk makes fit wait rather than pile up copies.
+    def __init__(self, path, every = 1000):
+        self.path = path
+        self.every = every
+        self.queue = Queue.Queue(maxsize=1)
+        self.thread = None
+        self.error = None
+
+    def save(self, state):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(state)
+
+    def run(self):
+        while True:
+            state = self.queue.get()
+            try:
+                if state is None:
+                    return
+                state = dict((key, value() if callable(value) else value) for key, value in state.items())
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, **state)
+                os.rename(tmp_path, self.path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        # blocks until every handed over snapshot is on disk.
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return dict((key, data[key]) for key in data.files)
+
+class FitLoop(object):
+    # the training loop shared by MLP and EnsembleMLP: minibatch gathering, metrics and logging, validation
+    # schedule, learning-rate schedule, early stopping and checkpoints. a model supplies
+    #   prepare_fit(batchsize)
+    #   train_step(xs_batch, ys_batch, labels_batch, eta, gradient_noise) -> (loss sum, correct count)
+    #   validator(xs, ys, labels, eval_batchsize) -> function returning (mean loss, accuracy)
+    #   weight_decay(decay), get_state(), set_state(state)
+    # and fit_log_models, the FitLog n_models. losses and accuracies are scalars or per-member arrays.
+    fit_log_models = None
+
+    def prepare_fit(self, batchsize):
+        pass
+
+    def fit_state(self, iepoch, ibatch, total_samples, sampler_state, metrics, schedule, early_stopping):
+        # everything fit needs to continue right after minibatch `ibatch` of epoch `iepoch`.
+        state = self.get_state()
+        state.update(schedule.get_state())
+        if early_stopping is not None:
+            state.update(early_stopping.get_state())
+        sampler_keys, sampler_rest = sampler_state
+        np_keys, np_rest = rng_get_state()
+        state.update({'fit_log': self.fit_log.snapshot(), 'sampler_rng': sampler_keys, 'np_rng': np_keys,
+            'metrics.loss_sum': metrics.loss_sum.copy(), 'metrics.correct': metrics.correct.copy()})
+        state['meta'] = np.array(json.dumps(dict(epoch=iepoch, batch=ibatch, total_samples=total_samples,
+            sampler_rng=sampler_rest, np_rng=np_rest,
+            metrics=dict(offset=metrics.offset, count=metrics.count, step=metrics.step))))
+        return state
+
+    def fit(self, xs_train, ys_train, xs_validation = None, ys_validation = None,
+            batchsize = 64, n_epoch = 5, learning_rate = 0.001, gradient_noise = 0.0, weight_decay = 0.0,
+            sampler = None, log_stride = 1, log_spill_dir = None, checkpoint = None, resume = None,
+            schedule = None, early_stopping = None,
+            validation_every = 1, validation_size = None, validation_seed = 0, eval_batchsize = None):
+        # checkpoint: a Checkpointer. resume: a checkpoint path (or loaded state) to continue from exactly;
+        # the other arguments must be the same as in the interrupted run.
+        # schedule and early_stopping monitor the validation loss, or the train loss without validation data;
+        # for an ensemble, the loss averaged over the members.
+        # validation runs every validation_every epochs and after the last one, on a fixed subset of
+        # validation_size samples, with eval_batchsize rows per batch (default batchsize).
+        assert len(xs_train.shape) == 2
+        assert xs_train.shape[0] == ys_train.shape[0]
+        N_train = len(ys_train)
+        if eval_batchsize is None:
+            eval_batchsize = batchsize
+        if xs_validation is not None and ys_validation is not None:
+            assert len(xs_validation.shape) == 2
+            assert xs_validation.shape[0] == ys_validation.shape[0]
+            assert xs_train.shape[1] == xs_validation.shape[1]
+            xs_validation, ys_validation = validation_subset(xs_validation, ys_validation, validation_size, validation_seed)
+            validate = self.validator(xs_validation, ys_validation, class_labels(ys_validation), eval_batchsize)
+        else:
+            validate = None
+        self.prepare_fit(batchsize)
+        if sampler is None:
+            sampler = MinibatchSampler('sequential')
+        if schedule is None:
+            schedule = LearningRateSchedule()
+        # class indices of the targets, once per fit rather than an argmax per minibatch.
+        labels_train = class_labels(ys_train)
+        blocks = sampler.blocks(N_train, batchsize)
+        if sampler.mode != 'sequential':
+            # every minibatch is gathered into reused (batchsize, dim) buffers. no reordered copy of the whole
+            # training set is made, so a memory-mapped one stays shared between sweep workers.
+            xs_buffer = np.empty((batchsize,) + xs_train.shape[1:], xs_train.dtype)
+            ys_buffer = np.empty((batchsize,) + ys_train.shape[1:], ys_train.dtype)
+            labels_buffer = np.empty(batchsize, labels_train.dtype)
+        total_samples = 0
+        if getattr(self, 'fit_log', None) is not None:
+            self.fit_log.close()
+        self.fit_log = FitLog(self.fit_log_models, log_spill_dir)
+        metrics = BatchMetrics(self.fit_log, log_stride)
+        suffix = '' if self.fit_log_models is None else ' (mean of %d)' % self.fit_log_models
+        start_epoch, start_batch = 0, 0
+        if resume is not None:
+            state = Checkpointer.load(resume) if isinstance(resume, basestring) else resume
+            meta = json.loads(str(state['meta']))
+            self.set_state(state)
+            schedule.set_state(state)
+            if early_stopping is not None:
+                early_stopping.set_state(state)
+            self.fit_log.restore(state['fit_log'])
+            rng_set_state(sampler.rng, state['sampler_rng'], meta['sampler_rng'])
+            rng_set_state(None, state['np_rng'], meta['np_rng'])
+            start_epoch, start_batch, total_samples = meta['epoch'], meta['batch'], meta['total_samples']
+        try:
+            for iepoch in range(start_epoch, n_epoch):
+                # the sampler state before drawing the order lets a resumed run redraw the same epoch.
+                sampler_state = rng_get_state(sampler.rng)
+                order = sampler.order(labels_train)
+                metrics.start_epoch(total_samples)
+                eta = learning_rate * schedule.factor(iepoch, n_epoch)
+                if resume is not None and iepoch == start_epoch:
+                    metrics.loss_sum[...] = state['metrics.loss_sum']
+                    metrics.correct[...] = state['metrics.correct']
+                    metrics.offset, metrics.count, metrics.step = [meta['metrics'][key] for key in ['offset', 'count', 'step']]
+                for ibatch, block in enumerate(blocks):
+                    if iepoch == start_epoch and ibatch < start_batch:
+                        continue
+                    if order is None:
+                        xs_batch, ys_batch, labels_batch = xs_train[block], ys_train[block], labels_train[block]
+                    else:
+                        n_batch = block.stop - block.start
+                        xs_batch = np.take(xs_train, order[block], axis=0, out=xs_buffer[:n_batch], mode='clip')
+                        ys_batch = np.take(ys_train, order[block], axis=0, out=ys_buffer[:n_batch], mode='clip')
+                        labels_batch = np.take(labels_train, order[block], out=labels_buffer[:n_batch], mode='clip')
+                    n_batch = xs_batch.shape[0]
+
+                    batch_loss, batch_correct = self.train_step(xs_batch, ys_batch, labels_batch, eta, gradient_noise)
+                    metrics.add(batch_loss, batch_correct, n_batch)
+
+                    if weight_decay > 0:
+                        self.weight_decay((1.0 - weight_decay) ** n_batch)
+
+                    if checkpoint is not None and metrics.step % checkpoint.every == 0:
+                        checkpoint.save(self.fit_state(iepoch, ibatch + 1, total_samples, sampler_state, metrics,
+                                schedule, early_stopping))
+
+                loss, acc = metrics.means()
+                total_samples += N_train
+                self.fit_log.append(total_samples, loss, acc, 'train')
+                print 'epoch %3d/%3d %-12s loss=%f acc=%f%s' % (iepoch + 1, n_epoch, 'train', np.mean(loss), np.mean(acc), suffix)
+
+                if validate is not None:
+                    if (iepoch + 1) % validation_every != 0 and iepoch + 1 < n_epoch:
+                        continue
+                    loss, acc = validate()
+                    self.fit_log.append(total_samples, loss, acc, 'validation')
+                    print 'epoch %3d/%3d %-12s loss=%f acc=%f%s' % (iepoch + 1, n_epoch, 'validation', np.mean(loss), np.mean(acc), suffix)
+
+                # with validation data, patience counts validations rather than epochs.
+                schedule.update(np.mean(loss))
+                if early_stopping is not None and early_stopping.update(np.mean(loss), self):
+                    print 'early stopping after epoch %d. best loss=%f' % (iepoch + 1, early_stopping.best)
+                    break
+        except KeyboardInterrupt:
+            if raw_input('terminate?').lower() == 'y':
+                raise
+        finally:
+            if checkpoint is not None:
+                checkpoint.wait()
+        if early_stopping is not None:
+            early_stopping.restore(self)
+
+    def get_fit_log(self): return self.fit_log.to_frame()
+
+class MLP(FitLoop):
+    def __init__(self, input_dim, layers, loss_type, learning = 'BP', verbose = False, preallocate = False,
+            transport_cache = None, dtype = np.float32, master_weights = False, fused = False, optimizer = None):
         self.backward_weights = []
         self.weights = []
-        self.updateable = []
-        self.funcs = []
         ch_in = input_dim
         for ch_out, activation_type, is_updatable in layers:
             w = np.random.randn(ch_out, ch_in + 1)
@@ -89,160 +856,707 @@ class MLP(object):
                 # "Random feedback weights support learning in deep neural networks", T.P.Lillicrap+, CoRR 2014.
                 w[:, :-1] *= 0 # zero initialize except for the bias.
                 b = normalize_xavier(np.random.randn(ch_out, ch_in), ch_out)
-                self.backward_weights.append(b)
+                self.backward_weights.append(b.astype(dtype))
             elif learning == 'FA-PI-W':
                 # Random feedback weights initialized with pseudo inverse pairs. (w determines b)
                 b = pseudo_inverse(w[:, :-1]).T
                 b = normalize_xavier(b, ch_out)
-                self.backward_weights.append(b)
+                self.backward_weights.append(b.astype(dtype))
             elif learning == 'FA-PI-B':
                 # Random feedback weights initialized with pseudo inverse pairs. (b determines w)
                 b = np.random.randn(ch_out, ch_in)
                 b = normalize_xavier(b, ch_out)
                 w = add_bias(normalize_xavier(pseudo_inverse(b).T, ch_in))
-                self.backward_weights.append(b)
+                self.backward_weights.append(b.astype(dtype))
             else:
                 raise RuntimeError('unknown learning method')
-            self.weights.append(w)
-            self.updateable.append(is_updatable)
-            self.funcs.append(activation_funcs[activation_type])
+            self.weights.append(w.astype(dtype))
             ch_in = ch_out
-        self.loss = loss_funcs[loss_type]
+        self.configure(input_dim, layers, loss_type, learning, verbose, preallocate,
+                transport_cache, dtype, master_weights, fused, optimizer)
+
+    def configure(self, input_dim, layers, loss_type, learning = 'BP', verbose = False, preallocate = False,
+            transport_cache = None, dtype = np.float32, master_weights = False, fused = False, optimizer = None):
+        # everything but the weights. shared by __init__ and load.
+        self.input_dim = input_dim
+        self.layers = [tuple(layer) for layer in layers]
+        self.loss_type = loss_type
+        self.updateable = [is_updatable for _, _, is_updatable in layers]
+        self.funcs = [activation_funcs[activation_type] for _, activation_type, _ in layers]
+        self.inplace_funcs = [inplace_activation_funcs[activation_type] for _, activation_type, _ in layers]
+        self.loss = losses[loss_type]()
         self.learning = learning
         self.verbose = verbose
+        # weights, feedback weights, activations and deltas are all kept in `dtype`.
+        # master_weights: accumulate updates in a float64 copy and round it into `weights`.
+        self.dtype = np.dtype(dtype)
+        self.master_weights = [w.astype(np.float64) for w in self.weights] if master_weights else None
+        # PI learning: pseudo inverses are reused between steps by the cache.
+        self.transport_cache = transport_cache if transport_cache is not None else TransportCache()
+        # the update rule applied to every updateable layer. plain sgd by default.
+        self.optimizer = optimizer if optimizer is not None else Optimizer()
+        # preallocate: keep per-layer input buffers with the bias column already filled.
+        # fused: use fused_layer instead of the bias column. its per-layer outputs are preallocated instead.
+        self.preallocate = preallocate
+        self.fused = fused
+        self.augmented = None
+        self.outputs = None
+        self.buffered = False
+        self.engines = {}
+
+    def allocate_buffers(self, batchsize):
+        if self.fused:
+            # outputs[i] is the (batchsize, ch_out) output of layer i.
+            self.outputs = [np.empty((batchsize, w.shape[0]), self.dtype) for w in self.weights]
+        else:
+            # augmented[i] is the (batchsize, ch_in + 1) input of layer i. the last column stays 1.
+            # products[i] takes the gemm of layer i before the activation writes it into augmented[i + 1].
+            self.augmented = [np.ones((batchsize, w.shape[1]), self.dtype) for w in self.weights]
+            self.products = [np.empty((batchsize, w.shape[0]), self.dtype) for w in self.weights]
+        # backward: deltas[i] and scratch[i] match the input of layer i, grad_* match weights[i].
+        self.deltas = [np.empty((batchsize, w.shape[1] - 1), self.dtype) for w in self.weights]
+        self.scratch = [np.empty((batchsize, w.shape[1] - 1), self.dtype) for w in self.weights]
+        self.grad_weights = [np.empty((w.shape[0], w.shape[1] - 1), self.dtype) for w in self.weights]
+        self.grad_biases = [np.empty(w.shape[0], self.dtype) for w in self.weights]
+
+    def buffer_size(self):
+        buffers = self.outputs if self.fused else self.augmented
+        return 0 if buffers is None else buffers[0].shape[0]
 
     def forward(self, xs_batch):
         assert len(xs_batch.shape) == 2
         n_batch, n_dim = xs_batch.shape
-        self.activations = [xs_batch]
-        for i, (w, (f, _)) in enumerate(zip(self.weights, self.funcs)):
-            x = self.activations[-1]
-            x = add_bias(x)
-            z = f(np.dot(x, w.T))
+        self.buffered = n_batch <= self.buffer_size()
+        if self.fused:
+            z = xs_batch.astype(self.dtype, copy=False)
+            self.activations = [z]
+            for i, (w, (f, _)) in enumerate(zip(self.weights, self.inplace_funcs)):
+                z = fused_layer(z, w, f, self.outputs[i][:n_batch] if self.buffered else None)
+                self.activations.append(z)
+                if self.verbose: print 'layer %d. fused -> %s' % (i, z.shape)
+            return z
+        if self.buffered:
+            self.augmented[0][:n_batch, :-1] = xs_batch
+            self.activations = [self.augmented[0][:n_batch, :-1]]
+        else:
+            self.activations = [xs_batch.astype(self.dtype, copy=False)]
+        for i, (w, (f, _), (f_inplace, _)) in enumerate(zip(self.weights, self.funcs, self.inplace_funcs)):
+            if self.buffered:
+                x = self.augmented[i][:n_batch]
+                z = np.dot(x, w.T, out=self.products[i][:n_batch])
+                # the activation writes straight into the next layer's input buffer, keeping its bias column.
+                z = f_inplace(z, self.augmented[i + 1][:n_batch, :-1] if i + 1 < len(self.weights) else None)
+            else:
+                x = add_bias(self.activations[-1])
+                z = f(np.dot(x, w.T))
             self.activations.append(z)
             if self.verbose: print 'layer %d. %s -> %s' % (i, x.shape, z.shape)
         return z
 
+    def transport(self, i):
+        w = self.weights[i]
+        if self.learning == 'BP':
+            return w[:, :-1]
+        elif self.learning == 'PI':
+            return self.transport_cache.get(i, w[:, :-1])
+        elif self.learning in ['FA', 'FA-PI-W', 'FA-PI-B']:
+            return self.backward_weights[i]
+
     def backward(self, delta, eta, gradient_noise = 0.0):
+        # frozen layers below the lowest updateable one need neither deltas nor gradients.
+        updateable = [i for i, u in enumerate(self.updateable) if u]
+        if not updateable:
+            return
+        lowest = updateable[0]
+        if self.buffered:
+            return self.backward_inplace(delta, eta, gradient_noise, lowest)
         deltas = [delta]
-        for i, (w, (_, df)) in list(enumerate(zip(self.weights, self.funcs)))[::-1]:
+        for i in range(lowest + 1, len(self.weights))[::-1]:
+            w, (_, df) = self.weights[i], self.funcs[i]
             delta = deltas[-1]
             if self.verbose: print 'calc delta for layer %d. delta %s -> weight %s' % (i, delta.shape, w.shape)
-            if self.learning == 'BP':
-                transport = w[:, :-1]
-            elif self.learning == 'PI':
-                transport = pseudo_inverse(w[:, :-1]).T
-            elif self.learning in ['FA', 'FA-PI-W', 'FA-PI-B']:
-                transport = self.backward_weights[i]
-            delta = df(self.activations[i]) * np.dot(delta, transport)
+            delta = df(self.activations[i]) * np.dot(delta, self.transport(i))
             deltas.append(delta)
         deltas.reverse()
 
-        for i, delta in enumerate(deltas[1:]):
+        for i, delta in enumerate(deltas, lowest):
             if self.verbose:
                 print 'update layer %d. delta %s, activation %s, weight %s' % (
                         i, delta.shape, self.activations[i].shape, self.weights[i].shape)
             if not self.updateable[i]:
                 continue
-            x = self.activations[i]
-            x = add_bias(x)
+            x = add_bias(self.activations[i])
             diff = np.dot(delta.T, x)
             if gradient_noise > 0:
                 diff += np.random.randn(*diff.shape) * gradient_noise
-            self.weights[i] -= eta * diff
+            self.update_weight(i, diff[:, :-1], diff[:, -1], eta)
+
+    def backward_inplace(self, delta, eta, gradient_noise = 0.0, lowest = 0):
+        # same update as backward, but into the preallocated buffers. no arrays are allocated.
+        # layer i is updated right after its transport is used, so deltas still see the old weights.
+        n_batch = delta.shape[0]
+        for i in range(lowest, len(self.weights))[::-1]:
+            x = self.activations[i]
+            if i > lowest:
+                delta_in = self.deltas[i][:n_batch]
+                np.dot(delta, self.transport(i), out=delta_in)
+                self.inplace_funcs[i][1](delta_in, x, self.scratch[i][:n_batch])
+            if self.updateable[i]:
+                grad_w, grad_b = self.grad_weights[i], self.grad_biases[i]
+                np.dot(delta.T, x, out=grad_w)
+                delta.sum(axis=0, out=grad_b)
+                if gradient_noise > 0:
+                    grad_w += np.random.randn(*grad_w.shape) * gradient_noise
+                    grad_b += np.random.randn(*grad_b.shape) * gradient_noise
+                self.update_weight(i, grad_w, grad_b, eta)
+            if i > lowest:
+                delta = delta_in
+
+    def update_weight(self, i, grad_w, grad_b, eta):
+        # in place. the gradients are overwritten by the optimizer.
+        w = self.weights[i] if self.master_weights is None else self.master_weights[i]
+        self.optimizer.step(i, w, grad_w, grad_b, eta)
+        if self.master_weights is not None:
+            self.weights[i][...] = w
+
+    def get_state(self):
+        # copies of everything training changes: weights, feedback weights, master weights, PI transports
+        # and the optimizer state.
+        state = {}
+        for name in ['weights', 'backward_weights', 'master_weights']:
+            for i, a in enumerate(getattr(self, name) or []):
+                state['%s.%d' % (name, i)] = a.copy()
+        state.update(self.transport_cache.get_state())
+        state.update(self.optimizer.get_state())
+        return state
+
+    def set_state(self, state):
+        for name in ['weights', 'backward_weights', 'master_weights']:
+            for i, a in enumerate(getattr(self, name) or []):
+                a[...] = state['%s.%d' % (name, i)]
+        self.transport_cache.set_state(state)
+        self.optimizer.set_state(state)
 
     def weight_decay(self, decay):
         for i in range(len(self.weights)):
             # decay weights but not biases
-            self.weights[i][:, :-1] *= decay
+            if self.master_weights is None:
+                self.weights[i][:, :-1] *= decay
+            else:
+                self.master_weights[i][:, :-1] *= decay
+                self.weights[i][...] = self.master_weights[i]
 
-    def fit(self, xs_train, ys_train, xs_validation = None, ys_validation = None,
-            batchsize = 64, n_epoch = 5, learning_rate = 0.001, gradient_noise = 0.0, weight_decay = 0.0):
-        assert len(xs_train.shape) == 2
-        assert xs_train.shape[0] == ys_train.shape[0]
-        N_train = len(ys_train)
-        if xs_validation is not None and ys_validation is not None:
-            assert len(xs_validation.shape) == 2
-            assert xs_validation.shape[0] == ys_validation.shape[0]
-            assert xs_train.shape[1] == xs_validation.shape[1]
-            N_validation = len(ys_validation)
-        else:
-            N_validation = 0
-        total_samples = 0
-        log = []
+    def prepare_fit(self, batchsize):
+        if self.preallocate and self.buffer_size() != batchsize:
+            self.allocate_buffers(batchsize)
+
+    def train_step(self, xs_batch, ys_batch, labels_batch, eta, gradient_noise = 0.0):
+        n_batch = xs_batch.shape[0]
+        ps_batch = self.forward(xs_batch)
+        batch_loss, delta = self.loss(ps_batch, ys_batch)
+        correct = np.count_nonzero(labels_batch == ps_batch.argmax(axis=1))
+        # targets in another dtype promote the gradient; the in-place backward needs the model dtype.
+        delta = delta.astype(self.dtype, copy=False)
+        delta /= float(n_batch)
+        self.backward(delta, eta, gradient_noise)
+        return batch_loss.sum(), correct
+
+    def validator(self, xs, ys, labels, eval_batchsize):
+        # through the inference engine into a preallocated output, so training activations are left untouched.
+        N = len(ys)
+        ps = np.empty((N, self.weights[-1].shape[0]), self.dtype)
+        def validate():
+            self.predict(xs, eval_batchsize, ps)
+            loss, acc = 0.0, 0.0
+            for i in range(0, N, eval_batchsize):
+                loss += self.loss(ps[i:i + eval_batchsize], ys[i:i + eval_batchsize], gradient=False)[0].sum()
+                acc += np.count_nonzero(labels[i:i + eval_batchsize] == ps[i:i + eval_batchsize].argmax(axis=1))
+            return loss / float(N), acc / float(N)
+        return validate
+
+    def inference_engine(self, batchsize = 64):
+        if batchsize not in self.engines:
+            self.engines[batchsize] = InferenceEngine(self, batchsize)
+        return self.engines[batchsize]
+
+    def predict(self, xs_test, batchsize = 64, out = None):
+        # does not go through forward: activations and training buffers are left untouched.
+        return self.inference_engine(batchsize).predict(xs_test, out)
+
+    ## serialization
+    # file layout: magic, uint64 header length, json header, then the raw arrays in C order,
+    # each starting at a multiple of model_alignment bytes. offsets in the header are relative to the data start.
+    model_magic = 'MLPMODEL'
+    model_alignment = 64
+
+    def save(self, path):
+        arrays = [('weights', w) for w in self.weights] + [('backward_weights', b) for b in self.backward_weights]
+        entries, offset = [], 0
+        for name, a in arrays:
+            offset = -(-offset // self.model_alignment) * self.model_alignment
+            entries.append(dict(name=name, offset=offset, shape=list(a.shape), dtype=a.dtype.str))
+            offset += a.nbytes
+        header = json.dumps(dict(input_dim=self.input_dim, layers=self.layers, loss_type=self.loss_type,
+            learning=self.learning, dtype=self.dtype.str, arrays=entries))
+        data_start = -(-(len(self.model_magic) + 8 + len(header)) // self.model_alignment) * self.model_alignment
+        with open(path, 'wb') as f:
+            f.write(self.model_magic)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for entry, (_, a) in zip(entries, arrays):
+                f.write('\0' * (data_start + entry['offset'] - f.tell()))
+                f.write(np.ascontiguousarray(a).tobytes())
+
+    @classmethod
+    def load(cls, path, mode = 'r', **kwargs):
+        # maps the file once; weights are views into it, so processes loading the same file share its page cache.
+        # mode 'r' gives read-only weights for inference, 'c' copy-on-write ones that can be trained further.
+        # kwargs go to configure (verbose, preallocate, fused, ...).
+        with open(path, 'rb') as f:
+            if f.read(len(cls.model_magic)) != cls.model_magic:
+                raise RuntimeError('not a saved MLP')
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length))
+        data_start = -(-(len(cls.model_magic) + 8 + header_length) // cls.model_alignment) * cls.model_alignment
+        raw = np.memmap(path, np.uint8, mode)
+        model = cls.__new__(cls)
+        model.weights, model.backward_weights = [], []
+        for entry in header['arrays']:
+            dtype = np.dtype(entry['dtype'])
+            start = data_start + entry['offset']
+            size = int(np.prod(entry['shape'])) * dtype.itemsize
+            getattr(model, entry['name']).append(raw[start:start + size].view(dtype).reshape(entry['shape']))
+        model.configure(header['input_dim'], header['layers'], header['loss_type'], header['learning'],
+                dtype=header['dtype'], **kwargs)
+        return model
+
+class InferenceEngine(object):
+    # prediction-only forward pass of an MLP. nothing is stored on the model; every thread ping-pongs
+    # between two private scratch buffers of batchsize rows, and the last layer writes into `out`,
+    # so several threads can predict with one model at the same time.
+    def __init__(self, model, batchsize = 1024):
+        self.model = model
+        self.batchsize = batchsize
+        self.width = max([w.shape[0] for w in model.weights[:-1]] + [0])
+        self.local = threading.local()
+
+    def scratch(self):
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = [np.empty(self.batchsize * self.width, self.model.dtype) for _ in range(2)]
+        return buffers
+
+    def predict(self, xs, out = None):
+        model = self.model
+        n_layers = len(model.weights)
+        N = xs.shape[0]
+        if out is None:
+            out = np.empty((N, model.weights[-1].shape[0]), model.dtype)
+        assert out.shape == (N, model.weights[-1].shape[0])
+        assert out.dtype == model.dtype and out.flags.c_contiguous
+        buffers = self.scratch()
+        for i in range(0, N, self.batchsize):
+            x = xs[i:i + self.batchsize].astype(model.dtype, copy=False)
+            n_batch = x.shape[0]
+            for j, (w, (f, _)) in enumerate(zip(model.weights, model.inplace_funcs)):
+                if j == n_layers - 1:
+                    z = out[i:i + n_batch]
+                else:
+                    z = buffers[j % 2][:n_batch * w.shape[0]].reshape(n_batch, w.shape[0])
+                x = fused_layer(x, w, f, z)
+        return out
+
+class PredictExecutor(object):
+    # splits one predict call into contiguous chunks served by a thread pool. numpy releases the GIL
+    # inside the GEMMs, and every pool thread gets its own scratch buffers from the shared engine.
+    def __init__(self, model, n_threads = 4, batchsize = 256):
+        self.engine = model.inference_engine(batchsize)
+        self.n_threads = n_threads
+        self.pool = multiprocessing.pool.ThreadPool(n_threads)
+
+    def predict(self, xs, out = None):
+        model = self.engine.model
+        N = xs.shape[0]
+        if out is None:
+            out = np.empty((N, model.weights[-1].shape[0]), model.dtype)
+        if N == 0:
+            return out
+        # one chunk per thread, rounded up to whole batches.
+        batchsize = self.engine.batchsize
+        chunk = -(-N // (self.n_threads * batchsize)) * batchsize
+        self.pool.map(lambda i: self.engine.predict(xs[i:i + chunk], out[i:i + chunk]), range(0, N, chunk))
+        return out
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class PendingPrediction(object):
+    def __init__(self, xs):
+        self.xs = xs
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def set(self, value = None, error = None):
+        self.value, self.error = value, error
+        self.done.set()
+
+    def result(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise RuntimeError('prediction timed out')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class MicroBatcher(object):
+    # merges small concurrent predict requests into one engine call. a background thread collects
+    # requests until max_rows are queued or max_delay seconds passed since the first one, copies them into
+    # a preallocated batch and hands every caller its rows. larger requests are served on their own.
+    def __init__(self, model, max_rows = 256, max_delay = 0.002):
+        self.engine = model.inference_engine(max_rows)
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.inputs = np.empty((max_rows, model.weights[0].shape[1] - 1), model.dtype)
+        self.outputs = np.empty((max_rows, model.weights[-1].shape[0]), model.dtype)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, xs):
+        # checked here, so that a malformed request fails only its caller and not the batch it would join.
+        xs = np.asarray(xs)
+        if xs.ndim != 2 or xs.shape[1] != self.inputs.shape[1]:
+            raise RuntimeError('expected (n, %d) inputs, got %s' % (self.inputs.shape[1], xs.shape))
+        request = PendingPrediction(xs)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('MicroBatcher closed')
+            self.queue.put(request)
+        return request
+
+    def predict(self, xs, timeout = None):
+        return self.submit(xs).result(timeout)
+
+    def run(self):
+        # None in the queue stops the thread. a request that did not fit is carried over in `pending`.
+        pending = []
+        while True:
+            request = pending.pop() if pending else self.queue.get()
+            if request is None:
+                self.drain()
+                return
+            batch, rows = [request], len(request.xs)
+            deadline = time.time() + self.max_delay
+            while rows < self.max_rows:
+                try:
+                    request = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if request is None or rows + len(request.xs) > self.max_rows:
+                    pending.append(request)
+                    break
+                batch.append(request)
+                rows += len(request.xs)
+            self.serve(batch, rows)
+
+    def serve(self, batch, rows):
         try:
-            for iepoch in range(n_epoch):
-                loss, acc, accum_batch_samples = 0.0, 0.0, 0
-                for i in range(0, N_train, batchsize):
-                    batchidx = range(i, min(N_train, i + batchsize))
-                    xs_batch = xs_train[batchidx]
-                    ys_batch = ys_train[batchidx]
-
-                    ps_batch = self.forward(xs_batch)
-                    delta = self.loss[1](ps_batch, ys_batch) / float(len(batchidx))
-                    loss += self.loss[0](ps_batch, ys_batch).sum()
-                    acc += np.count_nonzero(ys_batch.argmax(axis=1) == ps_batch.argmax(axis=1))
-                    accum_batch_samples += len(batchidx)
-                    log.append(dict(n=total_samples + accum_batch_samples, loss=loss/float(accum_batch_samples), acc=acc/float(accum_batch_samples), type='train-intermediate'))
-
-                    self.backward(delta, learning_rate, gradient_noise)
+            if rows > self.max_rows:
+                batch[0].set(self.engine.predict(batch[0].xs))
+                return
+            offsets = np.cumsum([0] + [len(r.xs) for r in batch])
+            for r, start, end in zip(batch, offsets[:-1], offsets[1:]):
+                self.inputs[start:end] = r.xs
+            self.engine.predict(self.inputs[:rows], self.outputs[:rows])
+            for r, start, end in zip(batch, offsets[:-1], offsets[1:]):
+                r.set(self.outputs[start:end].copy())
+        except Exception as e:
+            for r in batch:
+                if not r.done.is_set():
+                    r.set(error=e)
 
-                    if weight_decay > 0:
-                        self.weight_decay((1.0 - weight_decay) ** len(batchidx))
+    def drain(self):
+        # fails every request still queued behind the stop sentinel; submit refuses new ones once closed.
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            if request is not None:
+                request.set(error=RuntimeError('MicroBatcher closed'))
 
-                loss /= float(N_train)
-                acc /= float(N_train)
-                total_samples += N_train
-                log.append(dict(n=total_samples, loss=loss, acc=acc, type='train'))
-                print 'epoch %3d/%3d %-12s loss=%f acc=%f' % (iepoch + 1, n_epoch, 'train', loss, acc)
-
-                if N_validation > 0:
-                    loss, acc = 0.0, 0.0
-                    for i in range(0, N_validation, batchsize):
-                        batchidx = range(i, min(N_validation, i + batchsize))
-                        xs_batch = xs_validation[batchidx]
-                        ys_batch = ys_validation[batchidx]
-
-                        ps_batch = self.forward(xs_batch)
-                        loss += self.loss[0](ps_batch, ys_batch).sum()
-                        acc += np.count_nonzero(ys_batch.argmax(axis=1) == ps_batch.argmax(axis=1))
-                    loss /= float(N_validation)
-                    acc /= float(N_validation)
-                    log.append(dict(n=total_samples, loss=loss, acc=acc, type='validation'))
-                    print 'epoch %3d/%3d %-12s loss=%f acc=%f' % (iepoch + 1, n_epoch, 'validation', loss, acc)
-        except KeyboardInterrupt:
-            if raw_input('terminate?').lower() == 'y':
-                raise
-        self.fit_log = pd.DataFrame(log)
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
 
-    def get_fit_log(self): return self.fit_log
+class EnsembleMLP(FitLoop):
+    # n_models independent MLPs with the same layers, stacked along a leading axis of the weights
+    # and trained together on shared minibatches with batched matmuls.
+    # every member is initialized exactly like a separately constructed MLP.
+    def __init__(self, n_models, input_dim, layers, loss_type, learning = 'BP', verbose = False,
+            transport_caches = None, dtype = np.float32, optimizer = None):
+        if transport_caches is None:
+            transport_caches = [None] * n_models
+        models = [MLP(input_dim, layers, loss_type, learning, verbose, transport_cache=cache, dtype=dtype)
+                for cache in transport_caches]
+        self.n_models = n_models
+        self.fit_log_models = n_models
+        self.weights = [np.stack(ws) for ws in zip(*[m.weights for m in models])]
+        self.backward_weights = [np.stack(bs) for bs in zip(*[m.backward_weights for m in models])]
+        self.transport_caches = [m.transport_cache for m in models]
+        self.updateable = models[0].updateable
+        self.funcs = models[0].funcs
+        self.loss = models[0].loss
+        self.learning = learning
+        self.verbose = verbose
+        self.dtype = models[0].dtype
+        # the update rules are elementwise, so one optimizer over the stacked weights keeps members independent.
+        self.optimizer = optimizer if optimizer is not None else Optimizer()
+
+    def forward(self, xs_batch):
+        # (n_batch, input_dim) -> (n_models, n_batch, ch_out). the first layer broadcasts the shared input.
+        assert len(xs_batch.shape) == 2
+        z = xs_batch.astype(self.dtype, copy=False)
+        self.activations = [z]
+        for i, (w, (f, _)) in enumerate(zip(self.weights, self.funcs)):
+            z = f(np.matmul(z, w[:, :, :-1].transpose(0, 2, 1)) + w[:, np.newaxis, :, -1])
+            self.activations.append(z)
+            if self.verbose: print 'layer %d. ensemble -> %s' % (i, z.shape)
+        return z
+
+    def transport(self, i):
+        w = self.weights[i]
+        if self.learning == 'BP':
+            return w[:, :, :-1]
+        elif self.learning == 'PI':
+            return np.stack([cache.get(i, w[k, :, :-1]) for k, cache in enumerate(self.transport_caches)])
+        elif self.learning in ['FA', 'FA-PI-W', 'FA-PI-B']:
+            return self.backward_weights[i]
+
+    def backward(self, delta, eta, gradient_noise = 0.0):
+        # delta: (n_models, n_batch, ch_out). same rule as MLP.backward, per member.
+        updateable = [i for i, u in enumerate(self.updateable) if u]
+        if not updateable:
+            return
+        lowest = updateable[0]
+        for i in range(lowest, len(self.weights))[::-1]:
+            w, (_, df) = self.weights[i], self.funcs[i]
+            x = self.activations[i]
+            if i > lowest:
+                delta_in = df(x) * np.matmul(delta, self.transport(i))
+            if self.updateable[i]:
+                grad_w = np.matmul(delta.transpose(0, 2, 1), x)
+                grad_b = delta.sum(axis=1)
+                if gradient_noise > 0:
+                    grad_w += np.random.randn(*grad_w.shape) * gradient_noise
+                    grad_b += np.random.randn(*grad_b.shape) * gradient_noise
+                self.optimizer.step(i, w, grad_w, grad_b, eta)
+            if i > lowest:
+                delta = delta_in
+
+    def weight_decay(self, decay):
+        for w in self.weights:
+            # decay weights but not biases
+            w[:, :, :-1] *= decay
+
+    def evaluate(self, ps_batch, ys_batch, gradient = True, labels = None):
+        # per-member loss sums, correct counts, and the loss gradient for the shared targets.
+        # labels: class_labels(ys_batch), if already known.
+        n_models, n_batch = ps_batch.shape[:2]
+        ps_flat = ps_batch.reshape(n_models * n_batch, -1)
+        ys_flat = np.broadcast_to(ys_batch, (n_models,) + ys_batch.shape).reshape((n_models * n_batch,) + ys_batch.shape[1:])
+        loss, delta = self.loss(ps_flat, ys_flat, gradient)
+        acc = np.count_nonzero(ps_batch.argmax(axis=2) == (class_labels(ys_batch) if labels is None else labels), axis=1)
+        return loss.reshape(n_models, -1).sum(axis=1), acc, delta.reshape(ps_batch.shape) if gradient else None
+
+    def get_state(self):
+        # same as MLP.get_state, with one transport cache per member.
+        state = {}
+        for name in ['weights', 'backward_weights']:
+            for i, a in enumerate(getattr(self, name)):
+                state['%s.%d' % (name, i)] = a.copy()
+        for k, cache in enumerate(self.transport_caches):
+            state.update(cache.get_state('transport_cache.%d.' % k))
+        state.update(self.optimizer.get_state())
+        return state
+
+    def set_state(self, state):
+        for name in ['weights', 'backward_weights']:
+            for i, a in enumerate(getattr(self, name)):
+                a[...] = state['%s.%d' % (name, i)]
+        for k, cache in enumerate(self.transport_caches):
+            cache.set_state(state, 'transport_cache.%d.' % k)
+        self.optimizer.set_state(state)
+
+    def train_step(self, xs_batch, ys_batch, labels_batch, eta, gradient_noise = 0.0):
+        # every member sees the same minibatch.
+        n_batch = xs_batch.shape[0]
+        batch_loss, batch_acc, delta = self.evaluate(self.forward(xs_batch), ys_batch, labels=labels_batch)
+        delta /= float(n_batch)
+        self.backward(delta, eta, gradient_noise)
+        return batch_loss, batch_acc
+
+    def validator(self, xs, ys, labels, eval_batchsize):
+        # per-member losses and accuracies, through forward.
+        N = len(ys)
+        def validate():
+            loss, acc = np.zeros(self.n_models), np.zeros(self.n_models)
+            for i in range(0, N, eval_batchsize):
+                batch_loss, batch_acc, _ = self.evaluate(
+                        self.forward(xs[i:i + eval_batchsize]), ys[i:i + eval_batchsize], False, labels[i:i + eval_batchsize])
+                loss += batch_loss
+                acc += batch_acc
+            return loss / float(N), acc / float(N)
+        return validate
 
     def predict(self, xs_test, batchsize = 64):
+        # (n_models, N_test, ch_out)
         N_test = xs_test.shape[0]
-        ps = []
-        for i in range(0, N_test, batchsize):
-            batchidx = range(i, min(N_test, i + batchsize))
-            ps.append(self.forward(xs_test[batchidx]))
-        return np.vstack(ps)
+        return np.concatenate([self.forward(xs_test[i:i + batchsize]) for i in range(0, N_test, batchsize)], axis=1)
+
+## parallel sweeps
+blas_thread_setters = ['openblas_set_num_threads', 'openblas_set_num_threads64_', 'MKL_Set_Num_Threads',
+        'bli_thread_set_num_threads']
+
+def loaded_blas_libraries():
+    # paths of the BLAS shared objects mapped into this process. linux only; elsewhere nothing is found.
+    try:
+        with open('/proc/self/maps') as f:
+            paths = set(line.split()[-1] for line in f if '/' in line)
+    except IOError:
+        return []
+    return sorted(path for path in paths
+            if any(key in os.path.basename(path) for key in ['openblas', 'mkl_rt', 'blis']))
+
+def limit_blas_threads(n_threads):
+    # BLAS reads *_NUM_THREADS only when it is loaded, and forked workers inherit the parent's loaded library,
+    # so the thread count is set through the library itself. the environment still covers child processes.
+    for name in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[name] = str(n_threads)
+    for path in loaded_blas_libraries():
+        lib = ctypes.CDLL(path)
+        for setter in blas_thread_setters:
+            if hasattr(lib, setter):
+                getattr(lib, setter)(n_threads)
+
+class SharedDataset(object):
+    # named arrays stored as .npy files and opened read-only with mmap_mode='r', so every process
+    # that attaches maps the same page cache copy. pickling sends only the paths.
+    def __init__(self, directory, names):
+        self.directory = directory
+        self.names = list(names)
+        self.attach()
+
+    @classmethod
+    def create(cls, arrays, directory = None):
+        # arrays: dict of name -> array. defaults to a fresh directory on /dev/shm when it has room for them
+        # (docker's default is 64 MB), otherwise under the temp dir.
+        if directory is None:
+            size = sum(a.nbytes for a in arrays.values())
+            shm = '/dev/shm'
+            if os.path.isdir(shm):
+                st = os.statvfs(shm)
+                if st.f_bavail * st.f_frsize < 2 * size:
+                    shm = None
+            else:
+                shm = None
+            directory = tempfile.mkdtemp(prefix='mlp_dataset_', dir=shm)
+        try:
+            for name, a in arrays.items():
+                # np.save then rename, as in load_dataset. writing through a memmap would turn a full tmpfs into
+                # SIGBUS instead of an IOError.
+                path = os.path.join(directory, name + '.npy')
+                tmp_path = path + '.%d.tmp' % os.getpid()
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, a)
+                os.rename(tmp_path, path)
+        except:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return cls(directory, arrays.keys())
 
-def plot_fit_log(df_log):
+    def attach(self):
+        self.arrays = dict((name, np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r'))
+                for name in self.names)
+
+    def __getitem__(self, name): return self.arrays[name]
+
+    def __getstate__(self): return dict(directory=self.directory, names=self.names)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    def unlink(self):
+        self.arrays = {}
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def run_fit_job(job, arrays):
+    # job: dict(model_type, model_kwargs, fit_kwargs, seed, tags). returns the fit log tagged with job['tags'].
+    np.random.seed(job['seed'])
+    clf = job['model_type'](**job['model_kwargs'])
+    clf.fit(*arrays, **job['fit_kwargs'])
+    df = clf.get_fit_log()
+    for key, value in job['tags'].items():
+        df[key] = value
+    return df
+
+_sweep_arrays = {}
+
+def _sweep_worker_init(dataset, names, blas_threads):
+    # workers attach to the shared dataset as read-only views instead of receiving copies.
+    limit_blas_threads(blas_threads)
+    _sweep_arrays['arrays'] = [dataset[name] for name in names]
+
+def _sweep_worker(job):
+    return run_fit_job(job, _sweep_arrays['arrays'])
+
+def run_sweep(jobs, dataset, names, n_workers, blas_threads = 1):
+    # runs every job in a process pool and returns the fit logs in job order.
+    # names: the SharedDataset arrays passed to fit, i.e. train xs, ys and optionally validation xs, ys.
+    pool = multiprocessing.Pool(n_workers, _sweep_worker_init, (dataset, names, blas_threads))
+    try:
+        # a timeout keeps KeyboardInterrupt deliverable while waiting.
+        logs = pool.map_async(_sweep_worker, jobs).get(1 << 24)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return logs
+
+def plot_fit_log(log):
+    # log: a FitLog, read column-wise without building a DataFrame, or the DataFrame of get_fit_log.
+    def select(type):
+        return log.select(type) if isinstance(log, FitLog) else log[log['type'] == type]
+    def last(rows, column):
+        return np.asarray(rows[column])[-1]
     fig, axs = plt.subplots(2, 1)
-    df_train = df_log[df_log['type'] == 'train-intermediate']
+    df_train = select('train-intermediate')
     if len(df_train) > 0:
         axs[0].plot(df_train['n'], df_train['loss'], '-', alpha=0.5, color='blue')
         axs[1].plot(df_train['n'], df_train['acc'], '-', alpha=0.5, color='blue')
 
-    df_train = df_log[df_log['type'] == 'train']
+    df_train = select('train')
     if len(df_train) > 0:
         axs[0].plot(df_train['n'], df_train['loss'], 'o-', linewidth=1, color='blue', label='train')
         axs[1].plot(df_train['n'], df_train['acc'], 'o-', linewidth=1, color='blue', label='train')
 
-    df_validation = df_log[df_log['type'] == 'validation']
+    df_validation = select('validation')
     if len(df_validation) > 0:
         axs[0].plot(df_validation['n'], df_validation['loss'], 'o-', linewidth=1, color='red', label='validation')
         axs[1].plot(df_validation['n'], df_validation['acc'], 'o-', linewidth=1, color='red', label='validation')
-        axs[0].set_title('final train/val. loss = {:.3f}/{:.3f}'.format(df_train.iloc[-1]['loss'], df_validation.iloc[-1]['loss']))
-        axs[1].set_title('final train/val. acc. = {:.3f}/{:.3f}'.format(df_train.iloc[-1]['acc'], df_validation.iloc[-1]['acc']))
+        axs[0].set_title('final train/val. loss = {:.3f}/{:.3f}'.format(last(df_train, 'loss'), last(df_validation, 'loss')))
+        axs[1].set_title('final train/val. acc. = {:.3f}/{:.3f}'.format(last(df_train, 'acc'), last(df_validation, 'acc')))
 
     axs[0].set_xlabel('# total samples')
     axs[0].set_ylabel('loss')
@@ -256,12 +1570,74 @@ def plot_fit_log(df_log):
     fig.subplots_adjust(hspace=0.5)
     return fig, axs
 
-def category_encode(ys):
+def load_dataset(name, classes, normalize = True, cache_dir = None, data_file = None):
+    # returns (xs float32, ys int32) restricted to labels < classes.
+    # with cache_dir, the preprocessed arrays are kept as .npy files keyed by name, classes, normalization
+    # and source, and later calls open them with mmap_mode='r' without touching the source.
+    # data_file: a local .npz with 'data' and 'target' arrays, used instead of downloading. its basename,
+    # size and mtime go into the cache key, so a different or changed file is never served stale arrays.
+    if cache_dir:
+        if data_file is not None:
+            st = os.stat(data_file)
+            source = 'file-{}-{}-{}'.format(os.path.splitext(os.path.basename(data_file))[0], st.st_size, int(st.st_mtime))
+        else:
+            source = 'builtin'
+        key = '{}_classes{}_{}_{}'.format(name, classes, 'normalized' if normalize else 'raw', source)
+        paths = [os.path.join(cache_dir, key + suffix) for suffix in ['_xs.npy', '_ys.npy']]
+        if all(os.path.exists(path) for path in paths):
+            return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+    if data_file is not None:
+        dataset = np.load(data_file)
+        xs, ys = dataset['data'], dataset['target']
+    elif name == 'MNIST':
+        dataset = sklearn.datasets.fetch_mldata('MNIST original')
+        xs, ys = dataset.data, dataset.target
+    elif name == 'digits':
+        dataset = sklearn.datasets.load_digits()
+        xs, ys = dataset.data, dataset.target
+    else:
+        raise RuntimeError('unknown dataset')
+    xs = xs.astype(np.float32)
+    ys = ys.astype(np.int32)
+
+    if normalize:
+        xs = (xs - xs.min()) / xs.ptp() - 0.5
+    xs = xs[ys < classes]
+    ys = ys[ys < classes]
+
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for path, a in zip(paths, [xs, ys]):
+            # write then rename, so a concurrent reader never sees a partial file.
+            tmp_path = path + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'wb') as f:
+                np.save(f, a)
+            os.rename(tmp_path, path)
+        return tuple(np.load(path, mmap_mode='r') for path in paths)
+    return xs, ys
+
+# encodings: 'dense' float32 one-hot, 'sparse' scipy.sparse csr one-hot, 'index' int32 class indices.
+category_encodings = ['dense', 'sparse', 'index']
+
+def category_encode(ys, n_classes = None, encoding = 'dense'):
     assert len(ys.shape) == 1 or len(ys.shape) == 2 and ys.shape[1] == 1
-    ys_encoded = np.zeros((ys.shape[0], 1 + np.max(ys)), np.float32)
-    for i in range(len(ys)):
-        ys_encoded[i, int(ys[i])] = 1.0
-    return ys_encoded
+    ys = ys.reshape(-1).astype(np.int32)
+    if n_classes is None:
+        n_classes = 1 + np.max(ys)
+    if encoding == 'index':
+        return ys
+    elif encoding == 'sparse':
+        if scipy is None:
+            raise RuntimeError('sparse encoding requires scipy')
+        return scipy.sparse.csr_matrix((np.ones(len(ys), np.float32), ys, np.arange(len(ys) + 1)),
+                shape=(len(ys), n_classes))
+    elif encoding == 'dense':
+        ys_encoded = np.zeros((len(ys), n_classes), np.float32)
+        ys_encoded[np.arange(len(ys)), ys] = 1.0
+        return ys_encoded
+    raise RuntimeError('unknown category encoding')
 
 def demo():
     parser = argparse.ArgumentParser()
@@ -269,6 +1645,9 @@ def demo():
     parser.add_argument('-b', '--batchsize', type=int, default=128)
     parser.add_argument('-d', '--dataset', default='MNIST')
     parser.add_argument('-c', '--classes', type=int, default=10)
+    parser.add_argument('--cache_dir', default=os.path.expanduser('~/.cache/mlp_datasets'))
+    parser.add_argument('--data_file', default=None)
+    parser.add_argument('--targets', default='dense', choices=['dense', 'index'])
     parser.add_argument('-t', '--test_size', type=float, default=0.2)
     parser.add_argument('-l', '--learning_rate', type=float, default=0.001)
     parser.add_argument('-g', '--gradient_noise', type=float, default=0.0)
@@ -276,36 +1655,70 @@ def demo():
     parser.add_argument('-D', '--demo_type', default='single')
     parser.add_argument('-L', '--learning', default='BP')
     parser.add_argument('-T', '--print_test', action='store_true')
+    parser.add_argument('-P', '--preallocate', action='store_true')
+    parser.add_argument('-F', '--fused', action='store_true')
+    parser.add_argument('-E', '--ensemble', action='store_true')
+    parser.add_argument('-j', '--workers', type=int, default=0)
+    parser.add_argument('--log_stride', type=int, default=1)
+    parser.add_argument('--blas_threads', type=int, default=1)
+    parser.add_argument('-O', '--optimizer', default='sgd', choices=optimizer_types)
+    parser.add_argument('--momentum', type=float, default=0.9)
+    parser.add_argument('--lr_schedule', default='constant', choices=schedule_types)
+    parser.add_argument('--lr_warmup', type=int, default=0)
+    parser.add_argument('--patience', type=int, default=0)
+    parser.add_argument('--validation_every', type=int, default=1)
+    parser.add_argument('--validation_size', type=int, default=None)
+    parser.add_argument('--eval_batchsize', type=int, default=None)
+    parser.add_argument('-S', '--sampler', default='shuffled', choices=sampler_modes)
+    parser.add_argument('-s', '--seed', type=int, default=1)
+    parser.add_argument('--pinv_refresh', type=int, default=None)
+    parser.add_argument('--pinv_tolerance', type=float, default=None)
+    parser.add_argument('--pinv_method', default='inv', choices=pinv_methods)
+    parser.add_argument('--pinv_dtype', default=None, choices=['float32', 'float64'])
+    parser.add_argument('--pinv_rank', type=int, default=None)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'])
+    parser.add_argument('--master_weights', action='store_true')
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--checkpoint_every', type=int, default=1000)
+    parser.add_argument('--resume', default=None)
     parser.add_argument('--no_plot', action='store_true')
     args = parser.parse_args()
 
     np.random.seed(1)
 
     if args.dataset == 'MNIST':
-        dataset = sklearn.datasets.fetch_mldata('MNIST original')
         print 'problem: MNIST. lr=0.001, batchsize=50, epoch=20, [(80, relu), (80, relu)] will work (97% test acc)'
     elif args.dataset == 'digits':
-        dataset = sklearn.datasets.load_digits()
         print 'problem: digits. lr=0.001, batchsize=50, epoch=400, [(80, relu), (80, relu)] will work (99% test acc)'
-    xs = dataset.data.astype(np.float32)
-    ys = dataset.target.astype(np.int32)
-
-    if True:
-        xs = (xs - xs.min()) / xs.ptp() - 0.5
-    xs = xs[ys < args.classes]
-    ys = ys[ys < args.classes]
+    xs, ys = load_dataset(args.dataset, args.classes,
+            cache_dir=args.cache_dir, data_file=args.data_file)
     print 'dataset %d samples %d features. min=%f, max=%f' % (
             xs.shape[0], xs.shape[1], xs.min(), xs.max())
 
 
     n_classes = np.max(ys) + 1
-    ys = category_encode(ys)
+    ys = category_encode(ys, n_classes, args.targets)
+    loss_type = 'sparse_softmax_cross_entropy' if args.targets == 'index' else 'softmax_cross_entropy'
     N = len(ys)
     idx_train, idx_test = sklearn.cross_validation.train_test_split(
             range(N), test_size=args.test_size)
     xs_train, xs_test = xs[idx_train], xs[idx_test]
     ys_train, ys_test = ys[idx_train], ys[idx_test]
 
+    def transport_cache():
+        return TransportCache(args.pinv_refresh, args.pinv_tolerance,
+                args.pinv_method, args.pinv_dtype, args.pinv_rank)
+
+    def optimizer():
+        return Optimizer(args.optimizer, args.momentum)
+
+    def schedule():
+        return LearningRateSchedule(args.lr_schedule, args.lr_warmup)
+
+    def early_stopping():
+        # --patience 0 trains for all epochs.
+        return EarlyStopping(args.patience, restore_best=True) if args.patience > 0 else None
+
     hidden_layers = [
             (80, 'relu', 1),
             (80, 'relu', 1),
@@ -318,24 +1731,50 @@ def demo():
     #        (50, 'tanh', 1),
     #        ]
 
+    if args.demo_type == 'bench_pinv':
+        # the (ch_out, ch_in) blocks MLP.__init__ produces for these layers.
+        dims = [xs.shape[1]] + [ch for ch, _, _ in hidden_layers] + [n_classes]
+        print benchmark_pseudo_inverse(list(zip(dims[1:], dims[:-1]))).to_string()
+
     if args.demo_type == 'single':
         clf = MLP(xs.shape[1], hidden_layers + [
             (n_classes, 'identity', 1),
-            ], 'softmax_cross_entropy',
-            learning=args.learning)
+            ], loss_type,
+            learning=args.learning,
+            preallocate=args.preallocate,
+            transport_cache=transport_cache(),
+            dtype=args.dtype,
+            master_weights=args.master_weights,
+            fused=args.fused,
+            optimizer=optimizer())
 
-        clf.fit(xs_train, ys_train, xs_test, ys_test,
-                batchsize=args.batchsize,
-                n_epoch=args.epoch,
-                learning_rate=args.learning_rate,
-                gradient_noise=args.gradient_noise,
-                weight_decay=args.weight_decay)
+        checkpoint = Checkpointer(args.checkpoint, args.checkpoint_every) if args.checkpoint else None
+        try:
+            clf.fit(xs_train, ys_train, xs_test, ys_test,
+                    batchsize=args.batchsize,
+                    n_epoch=args.epoch,
+                    learning_rate=args.learning_rate,
+                    gradient_noise=args.gradient_noise,
+                    weight_decay=args.weight_decay,
+                    sampler=MinibatchSampler(args.sampler, args.seed),
+                    log_stride=args.log_stride,
+                    checkpoint=checkpoint,
+                    resume=args.resume,
+                    schedule=schedule(),
+                    early_stopping=early_stopping(),
+                    validation_every=args.validation_every,
+                    validation_size=args.validation_size,
+                    validation_seed=args.seed,
+                    eval_batchsize=args.eval_batchsize)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
 
         if args.print_test:
-            for p, t in zip(clf.predict(xs_test).argmax(axis=1), ys_test.argmax(axis=1)):
+            for p, t in zip(clf.predict(xs_test).argmax(axis=1), class_labels(ys_test)):
                 print p, t, 'o' if p == t else 'x'
 
-        fig, axs = plot_fit_log(clf.get_fit_log())
+        fig, axs = plot_fit_log(clf.fit_log)
         fig.suptitle('{} classification with {} learning.'.format(
             args.dataset, args.learning))
         fig.savefig('result_{}_{}.png'.format(args.dataset, args.learning))
@@ -344,25 +1783,55 @@ def demo():
     if args.demo_type == 'compare':
         learning_methods = ['BP', 'PI', 'FA', 'FA-PI-W', 'FA-PI-B']
         n_iter = 2
-        logs = []
+        model_kwargs = dict(input_dim=xs.shape[1], layers=hidden_layers + [
+            (n_classes, 'identity', 1),
+            ], loss_type=loss_type, dtype=args.dtype)
+        fit_kwargs = dict(batchsize=args.batchsize,
+                n_epoch=args.epoch,
+                learning_rate=args.learning_rate,
+                gradient_noise=args.gradient_noise,
+                weight_decay=args.weight_decay,
+                log_stride=args.log_stride,
+                validation_every=args.validation_every,
+                validation_size=args.validation_size,
+                validation_seed=args.seed,
+                eval_batchsize=args.eval_batchsize)
+        # every job seeds the global RNG itself, so serial and parallel sweeps give the same runs.
+        jobs = []
         for learning in learning_methods:
+            if args.ensemble:
+                # all runs of this learning method at once, on the same minibatches.
+                jobs.append(dict(model_type=EnsembleMLP,
+                    model_kwargs=dict(model_kwargs, n_models=n_iter, learning=learning,
+                        transport_caches=[transport_cache() for _ in range(n_iter)],
+                        optimizer=optimizer()),
+                    fit_kwargs=dict(fit_kwargs, sampler=MinibatchSampler(args.sampler, args.seed), schedule=schedule()),
+                    seed=args.seed + len(jobs),
+                    tags=dict(learning=learning)))
+                continue
             for iter in range(n_iter):
-                clf = MLP(xs.shape[1], hidden_layers + [
-                    (n_classes, 'identity', 1),
-                    ], 'softmax_cross_entropy',
-                    learning=learning)
-
-                clf.fit(xs_train, ys_train, xs_test, ys_test,
-                        batchsize=args.batchsize,
-                        n_epoch=args.epoch,
-                        learning_rate=args.learning_rate,
-                        gradient_noise=args.gradient_noise,
-                        weight_decay=args.weight_decay)
-
-                df = clf.get_fit_log()
-                df.iloc[:]['learning'] = learning
-                df.iloc[:]['iter'] = iter
-                logs.append(df)
+                jobs.append(dict(model_type=MLP,
+                    model_kwargs=dict(model_kwargs, learning=learning,
+                        preallocate=args.preallocate,
+                        transport_cache=transport_cache(),
+                        master_weights=args.master_weights,
+                        fused=args.fused,
+                        optimizer=optimizer()),
+                    fit_kwargs=dict(fit_kwargs, sampler=MinibatchSampler(args.sampler, args.seed + iter), schedule=schedule()),
+                    seed=args.seed + len(jobs),
+                    tags=dict(learning=learning, iter=iter)))
+
+        if args.workers > 0:
+            names = ['xs_train', 'ys_train', 'xs_test', 'ys_test']
+            dataset = SharedDataset.create(dict(zip(names, [xs_train, ys_train, xs_test, ys_test])))
+            try:
+                logs = run_sweep(jobs, dataset, names, args.workers, args.blas_threads)
+            finally:
+                dataset.unlink()
+        else:
+            logs = [run_fit_job(job, (xs_train, ys_train, xs_test, ys_test)) for job in jobs]
+        # ensemble members are logged as 'model'.
+        logs = [df.rename(columns={'model': 'iter'}) for df in logs]
         logs = pd.concat(logs)
 
 